@@ -1,34 +1,54 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 import yfinance as yf
-from typing import List, Optional, Dict, Any
+import orjson
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from typing import List, Optional, Dict
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import anyio
+import threading
+from collections import OrderedDict
 import time
+import hashlib
+import re
 import os
 import logging
-import atexit
-import signal
-from functools import wraps
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis L2 cache is optional
+    aioredis = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Create a shared ThreadPoolExecutor
-executor = ThreadPoolExecutor(max_workers=10)
+# Worker threads for blocking yfinance calls come from anyio's shared pool, raised at startup
+THREAD_LIMIT = 64
 
-# Ensure proper cleanup on shutdown
-def cleanup():
-    executor.shutdown(wait=False)
+# Shared HTTP session so yfinance calls reuse pooled keep-alive connections
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
 
-atexit.register(cleanup)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared clients before serving and release them on shutdown"""
+    await startup_event()
+    yield
+    await shutdown_event()
 
 app = FastAPI(
     title="FinCredo - Indian Stock Market API",
     description="Get Indian stock market data for NSE-listed companies",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Optimized CORS for n8n
@@ -40,67 +60,286 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Enhanced caching with different TTLs
-cache = {}
+# Compress larger bodies (full stock data, batches, watchlists); small price payloads are left as-is
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Enhanced caching with different TTLs: one cache per data_type so each endpoint gets its own shape
+# (OrderedDicts kept in LRU order, keyed by symbol)
 PRICE_CACHE_DURATION = 30  # 30 seconds for price data
+SUMMARY_CACHE_DURATION = 300  # 5 minutes for summaries (they carry the current price)
 COMPANY_CACHE_DURATION = 3600  # 1 hour for company data
-MAX_CACHE_SIZE = 1000
-
-def get_cached_data(symbol: str, cache_type: str = "price"):
-    cache_key = f"{cache_type}:{symbol}"
-    if cache_key in cache:
-        data, timestamp = cache[cache_key]
-        duration = PRICE_CACHE_DURATION if cache_type == "price" else COMPANY_CACHE_DURATION
-        if time.time() - timestamp < duration:
-            return data
+TTLS = {
+    "price_only": PRICE_CACHE_DURATION,
+    "summary": SUMMARY_CACHE_DURATION,
+    "full": COMPANY_CACHE_DURATION,
+}
+caches = {data_type: OrderedDict() for data_type in TTLS}
+MAX_CACHE_SIZE = 1000  # per cache
+PRICE_STALE_GRACE = 300  # expired prices may be served this long while refreshing in the background
+
+# Hit/miss counters for /metrics (only updated from the event loop thread)
+cache_stats = {"hits": 0, "misses": 0, "l2_hits": 0}
+# /metrics logs a warning below this hit ratio (after enough lookups) as a hint to raise the TTLs
+LOW_HIT_RATIO = 0.5
+MIN_LOOKUPS_FOR_RATIO = 100
+
+# Worker threads and the event loop both touch the caches; keep compound updates atomic
+cache_lock = threading.Lock()
+
+def get_cache_entry(symbol: str, data_type: str = "price_only"):
+    """Fresh (data, deadline, payload, etag) entry, or None (etag is only set for price_only)"""
+    cache = caches[data_type]
+    with cache_lock:
+        entry = cache.get(symbol)
+        fresh = entry is not None and time.monotonic() < entry[1]
+        if fresh:
+            cache.move_to_end(symbol)
+    if fresh:
+        cache_stats["hits"] += 1
+        return entry
+    cache_stats["misses"] += 1
+    return None
+
+def get_stale_price_entry(symbol: str):
+    """Expired price entry still inside PRICE_STALE_GRACE, or None (not counted in hit/miss stats)"""
+    with cache_lock:
+        entry = caches["price_only"].get(symbol)
+    if entry is not None and time.monotonic() < entry[1] + PRICE_STALE_GRACE:
+        return entry
     return None
 
-def set_cache_data(symbol: str, data: dict, cache_type: str = "price"):
-    cache_key = f"{cache_type}:{symbol}"
-    # Simple cache size management
-    if len(cache) > MAX_CACHE_SIZE:
-        # Remove oldest entries
-        oldest_key = min(cache.keys(), key=lambda k: cache[k][1])
-        del cache[oldest_key]
+def set_cache_data(symbol: str, data: dict, data_type: str = "price_only", ttl: Optional[float] = None):
+    cache = caches[data_type]
+    # Serialize once here so cache hits are served without re-encoding;
+    # store a monotonic deadline so lookups are a single comparison immune to wall-clock jumps
+    payload = orjson.dumps({**data, "cached": True})
+    deadline = time.monotonic() + (TTLS[data_type] if ttl is None else ttl)
+    # Only /price sends ETags; tag the payload bytes already built instead of re-serializing
+    etag = make_etag(payload) if data_type == "price_only" else None
+    entry = (data, deadline, payload, etag)
     
-    cache[cache_key] = (data, time.time())
-
-# Add timeout decorator
-def timeout_handler(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        def timeout_signal_handler(signum, frame):
-            raise TimeoutError("Request timed out")
-        
-        # Set timeout for Windows (signal doesn't work on Windows)
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            logger.error(f"Function {func.__name__} failed: {str(e)}")
-            raise
-    return wrapper
+    with cache_lock:
+        cache.pop(symbol, None)
+        # Evict least recently used entries in O(1)
+        while len(cache) >= MAX_CACHE_SIZE:
+            cache.popitem(last=False)
+        cache[symbol] = entry
+    return entry
+
+# Optional Redis L2 shared by all workers/replicas (set REDIS_URL to enable)
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = None
+if REDIS_URL and aioredis is not None:
+    # Short timeouts so a slow or missing Redis degrades to L1-only instead of stalling requests
+    redis_client = aioredis.from_url(REDIS_URL, socket_connect_timeout=0.5, socket_timeout=0.5)
+elif REDIS_URL:
+    logger.warning("REDIS_URL is set but the redis package is not installed; using in-process cache only")
+
+async def lookup_cache(symbol: str, data_type: str = "price_only"):
+    """Cache entry from L1, falling back to Redis (and repopulating L1) when configured"""
+    return (await lookup_cache_many([symbol], data_type)).get(symbol)
+
+async def lookup_cache_many(symbols: List[str], data_type: str = "price_only") -> Dict[str, tuple]:
+    """Fresh cache entries by symbol: L1 first, then one Redis round trip for the L1 misses"""
+    found = {}
+    missing = []
+    for symbol in symbols:
+        entry = get_cache_entry(symbol, data_type)
+        if entry:
+            found[symbol] = entry
+        else:
+            missing.append(symbol)
+    if not missing or redis_client is None:
+        return found
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for symbol in missing:
+            key = f"fincredo:{data_type}:{symbol}"
+            pipe.get(key).pttl(key)
+        replies = await pipe.execute()
+    except Exception as e:
+        logger.warning("Redis read failed: %s: %s", type(e).__name__, e)
+        return found
+    for symbol, data, ttl_ms in zip(missing, replies[::2], replies[1::2]):
+        if data and ttl_ms > 0:
+            cache_stats["l2_hits"] += 1
+            # Keep the L1 copy's expiry aligned with the remaining Redis TTL
+            found[symbol] = set_cache_data(symbol, orjson.loads(data), data_type, ttl=ttl_ms / 1000)
+    return found
+
+async def store_l2(results: List[dict], data_type: str = "price_only"):
+    """Write successful results through to Redis in one round trip"""
+    if redis_client is None:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for r in results:
+            if "error" not in r:
+                pipe.set(f"fincredo:{data_type}:{r['symbol']}", orjson.dumps(r), ex=TTLS[data_type])
+        await pipe.execute()
+    except Exception as e:
+        logger.warning("Redis write failed: %s: %s", type(e).__name__, e)
+
+def make_etag(payload: bytes) -> str:
+    """Short weak ETag over a serialized cache payload (the live response differs only in "cached")"""
+    return 'W/"%s"' % hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison: ignore the W/ prefix on either side
+    opaque = etag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == opaque for t in if_none_match.split(","))
+
+# Response field tables: (output key, Yahoo keys tried in order, default)
+PRICE_FIELDS = (
+    ("currentPrice", ("currentPrice", "regularMarketPrice"), "N/A"),
+    ("change", ("regularMarketChange",), 0),
+    ("changePercent", ("regularMarketChangePercent",), 0),
+    ("volume", ("volume", "regularMarketVolume"), 0),
+    # Not in fast_info, so usually "N/A" here; kept so the /price shape doesn't change
+    ("dividendYield", ("dividendYield",), "N/A"),
+    ("roe", ("returnOnEquity",), "N/A"),
+    ("debtToEquity", ("debtToEquity",), "N/A"),
+    ("bookValue", ("bookValue",), "N/A"),
+    ("beta", ("beta",), "N/A"),
+    ("faceValue", ("faceValue",), "N/A"),
+)
+
+SUMMARY_FIELDS = (
+    ("name", ("longName", "shortName"), "N/A"),
+    ("currentPrice", ("currentPrice", "regularMarketPrice"), "N/A"),
+    ("change", ("regularMarketChange",), 0),
+    ("changePercent", ("regularMarketChangePercent",), 0),
+    ("peRatio", ("trailingPE", "forwardPE"), "N/A"),
+    ("eps", ("trailingEps", "forwardEps"), "N/A"),
+    ("priceToBook", ("priceToBook",), "N/A"),
+    ("dividendYield", ("dividendYield",), "N/A"),
+    ("roe", ("returnOnEquity",), "N/A"),
+    ("debtToEquity", ("debtToEquity",), "N/A"),
+    ("bookValue", ("bookValue",), "N/A"),
+    ("beta", ("beta",), "N/A"),
+    ("faceValue", ("faceValue",), "N/A"),
+    ("sector", ("sector",), "N/A"),
+    ("marketCap", ("marketCap",), "N/A"),
+    ("volume", ("volume", "regularMarketVolume"), 0),
+    ("fiftyTwoWeekHigh", ("fiftyTwoWeekHigh",), "N/A"),
+    ("fiftyTwoWeekLow", ("fiftyTwoWeekLow",), "N/A"),
+)
+
+FULL_FIELDS = (
+    # Basic Price Data
+    ("name", ("longName", "shortName"), "N/A"),
+    ("currentPrice", ("currentPrice", "regularMarketPrice"), "N/A"),
+    ("open", ("open", "regularMarketOpen"), "N/A"),
+    ("dayHigh", ("dayHigh", "regularMarketDayHigh"), "N/A"),
+    ("dayLow", ("dayLow", "regularMarketDayLow"), "N/A"),
+    ("previousClose", ("previousClose", "regularMarketPreviousClose"), "N/A"),
+    ("change", ("regularMarketChange",), 0),
+    ("changePercent", ("regularMarketChangePercent",), 0),
+    
+    # Volume & Market Data
+    ("volume", ("volume", "regularMarketVolume"), 0),
+    ("marketCap", ("marketCap",), "N/A"),
+    ("currency", ("currency",), "INR"),
+    
+    # 52-Week Data
+    ("fiftyTwoWeekHigh", ("fiftyTwoWeekHigh",), "N/A"),
+    ("fiftyTwoWeekLow", ("fiftyTwoWeekLow",), "N/A"),
+    
+    # Valuation Metrics
+    ("peRatio", ("trailingPE", "forwardPE"), "N/A"),
+    ("priceToBook", ("priceToBook",), "N/A"),
+    ("eps", ("trailingEps", "forwardEps"), "N/A"),
+    ("dividendYield", ("dividendYield",), "N/A"),
+    ("roe", ("returnOnEquity",), "N/A"),
+    ("debtToEquity", ("debtToEquity",), "N/A"),
+    ("bookValue", ("bookValue",), "N/A"),
+    ("beta", ("beta",), "N/A"),
+    ("faceValue", ("faceValue",), "N/A"),
+    
+    # Company Information
+    ("sector", ("sector",), "N/A"),
+    ("industry", ("industry",), "N/A"),
+    ("exchange", ("exchange",), "NSE"),
+)
+
+def compile_fields(fields):
+    """Flatten a field table into (output key, primary key, fallback key or None, default) rows"""
+    rows = []
+    for out, keys, default in fields:
+        if len(keys) > 2:
+            raise ValueError(f"Field {out} has more than one fallback key")
+        rows.append((out, keys[0], keys[1] if len(keys) == 2 else None, default))
+    return tuple(rows)
+
+# Compiled rows per data_type; anything unrecognized gets the full table
+TABLES = {
+    "price_only": compile_fields(PRICE_FIELDS),
+    "summary": compile_fields(SUMMARY_FIELDS),
+    "full": compile_fields(FULL_FIELDS),
+}
+
+def build_stock_result(symbol: str, data: dict, data_type: str = "full", now: Optional[int] = None):
+    """Map a Yahoo quote/info dict onto the response shape for data_type (now: shared batch timestamp)"""
+    rows = TABLES.get(data_type) or TABLES["full"]
+    
+    # Falsy values fall through to the default, same as `data.get(a) or data.get(b) or default`
+    result = {"symbol": symbol}
+    result.update({
+        out: data.get(primary) or (fallback and data.get(fallback)) or default
+        for out, primary, fallback, default in rows
+    })
+    result["timestamp"] = now if now is not None else int(time.time())
+    return result
+
+def get_fast_price_data(stock):
+    """Price fields from Ticker.fast_info, keyed like Ticker.info"""
+    fi = stock.fast_info
+    last_price = fi.last_price
+    previous_close = fi.previous_close
+    data = {
+        "currentPrice": float(last_price) if last_price else None,
+        "volume": int(fi.last_volume or 0)
+    }
+    if last_price and previous_close:
+        change = float(last_price - previous_close)
+        data["regularMarketChange"] = round(change, 2)
+        data["regularMarketChangePercent"] = round(change / float(previous_close) * 100, 2)
+    return data
+
+@lru_cache(maxsize=4096)
+def normalize_symbol(symbol: str) -> str:
+    """Canonical uppercase NSE ticker with the .NS suffix; applied once where symbols enter the API"""
+    symbol = symbol.strip().upper()
+    return symbol if symbol.endswith('.NS') else symbol + '.NS'
 
-@timeout_handler
 def fetch_optimized_stock_data(symbol: str, data_type: str = "full"):
-    """Optimized data fetching with selective fields and timeout"""
+    """Optimized data fetching with selective fields (callers bound it with FETCH_TIMEOUT)"""
     try:
-        logger.info(f"Fetching data for {symbol} with type {data_type}")
+        logger.info("Fetching data for %s with type %s", symbol, data_type)
         
-        # Add .NS suffix if not present
-        if not symbol.endswith('.NS'):
-            symbol += '.NS'
-            
-        # Create ticker with timeout
-        stock = yf.Ticker(symbol)
+        # Create ticker on the shared pooled session
+        stock = yf.Ticker(symbol, session=session)
         
         # Test if symbol exists with a quick call
         try:
             # Add more detailed error logging
-            logger.info(f"Creating yfinance ticker for {symbol}")
-            data = stock.info
-            logger.info(f"Retrieved info for {symbol}: {len(data) if data else 0} fields")
+            logger.info("Creating yfinance ticker for %s", symbol)
+            if data_type == "price_only":
+                # fast_info skips the full quoteSummary download for price fields
+                data = get_fast_price_data(stock)
+                if not data["currentPrice"]:
+                    error_msg = f"No price available for {symbol}"
+                    logger.error(error_msg)
+                    return {"error": error_msg}
+            else:
+                data = stock.info
+            logger.info("Retrieved info for %s: %s fields", symbol, len(data) if data else 0)
             
-            if not data or len(data) < 5:
+            if not data or (data_type != "price_only" and len(data) < 5):
                 error_msg = f"No data available for {symbol} - received {len(data) if data else 0} fields"
                 logger.error(error_msg)
                 return {"error": error_msg}
@@ -109,169 +348,291 @@ def fetch_optimized_stock_data(symbol: str, data_type: str = "full"):
             error_msg = f"Error in yfinance data fetch for {symbol}: {type(e).__name__}: {str(e)}"
             logger.error(error_msg)
             return {"error": error_msg}
-            
-        if data_type == "price_only":
-            # Minimal data for high-frequency price updates
-            result = {
-                "symbol": symbol,
-                "currentPrice": data.get("currentPrice") or data.get("regularMarketPrice") or "N/A",
-                "change": data.get("regularMarketChange") or 0,
-                "changePercent": data.get("regularMarketChangePercent") or 0,
-                "volume": data.get("volume") or data.get("regularMarketVolume") or 0,
-                "dividendYield": data.get("dividendYield") or "N/A",
-                "roe": data.get("returnOnEquity") or "N/A",
-                "debtToEquity": data.get("debtToEquity") or "N/A",
-                "bookValue": data.get("bookValue") or "N/A",
-                "beta": data.get("beta") or "N/A",
-                "faceValue": data.get("faceValue") or "N/A",
-                "timestamp": int(time.time())
-            }
-        elif data_type == "summary":
-            # Key metrics for n8n workflows
-            result = {
-                "symbol": symbol,
-                "name": data.get("longName") or data.get("shortName") or "N/A",
-                "currentPrice": data.get("currentPrice") or data.get("regularMarketPrice") or "N/A",
-                "change": data.get("regularMarketChange") or 0,
-                "changePercent": data.get("regularMarketChangePercent") or 0,
-                "peRatio": data.get("trailingPE") or data.get("forwardPE") or "N/A",
-                "eps": data.get("trailingEps") or data.get("forwardEps") or "N/A",
-                "priceToBook": data.get("priceToBook") or "N/A",
-                "dividendYield": data.get("dividendYield") or "N/A",
-                "roe": data.get("returnOnEquity") or "N/A",
-                "debtToEquity": data.get("debtToEquity") or "N/A",
-                "bookValue": data.get("bookValue") or "N/A",
-                "beta": data.get("beta") or "N/A",
-                "faceValue": data.get("faceValue") or "N/A",
-                "sector": data.get("sector") or "N/A",
-                "marketCap": data.get("marketCap") or "N/A",
-                "volume": data.get("volume") or data.get("regularMarketVolume") or 0,
-                "fiftyTwoWeekHigh": data.get("fiftyTwoWeekHigh") or "N/A",
-                "fiftyTwoWeekLow": data.get("fiftyTwoWeekLow") or "N/A",
-                "timestamp": int(time.time())
-            }
-        else:
-            # Simplified full data to prevent hanging
-            result = {
-                # Basic Price Data
-                "symbol": symbol,
-                "name": data.get("longName") or data.get("shortName") or "N/A",
-                "currentPrice": data.get("currentPrice") or data.get("regularMarketPrice") or "N/A",
-                "open": data.get("open") or data.get("regularMarketOpen") or "N/A",
-                "dayHigh": data.get("dayHigh") or data.get("regularMarketDayHigh") or "N/A",
-                "dayLow": data.get("dayLow") or data.get("regularMarketDayLow") or "N/A",
-                "previousClose": data.get("previousClose") or data.get("regularMarketPreviousClose") or "N/A",
-                "change": data.get("regularMarketChange") or 0,
-                "changePercent": data.get("regularMarketChangePercent") or 0,
-                
-                # Volume & Market Data
-                "volume": data.get("volume") or data.get("regularMarketVolume") or 0,
-                "marketCap": data.get("marketCap") or "N/A",
-                "currency": data.get("currency") or "INR",
-                
-                # 52-Week Data
-                "fiftyTwoWeekHigh": data.get("fiftyTwoWeekHigh") or "N/A",
-                "fiftyTwoWeekLow": data.get("fiftyTwoWeekLow") or "N/A",
-                
-                # Valuation Metrics
-                "peRatio": data.get("trailingPE") or data.get("forwardPE") or "N/A",
-                "priceToBook": data.get("priceToBook") or "N/A",
-                "eps": data.get("trailingEps") or data.get("forwardEps") or "N/A",
-                "dividendYield": data.get("dividendYield") or "N/A",
-                "roe": data.get("returnOnEquity") or "N/A",
-                "debtToEquity": data.get("debtToEquity") or "N/A",
-                "bookValue": data.get("bookValue") or "N/A",
-                "beta": data.get("beta") or "N/A",
-                "faceValue": data.get("faceValue") or "N/A",
-                
-                # Company Information
-                "sector": data.get("sector") or "N/A",
-                "industry": data.get("industry") or "N/A",
-                "exchange": data.get("exchange") or "NSE",
-                
-                # Timestamps
-                "timestamp": int(time.time())
-            }
         
-        logger.info(f"Successfully fetched data for {symbol}")
-        set_cache_data(symbol, result, "price" if data_type == "price_only" else "company")
+        result = build_stock_result(symbol, data, data_type)
+        
+        logger.info("Successfully fetched data for %s", symbol)
+        set_cache_data(symbol, result, data_type)
+        if data_type == "full":
+            # Same info already covers the summary shape, so /summary doesn't refetch it
+            set_cache_data(symbol, build_stock_result(symbol, data, "summary", result["timestamp"]), "summary")
         return result
         
-    except TimeoutError:
-        logger.error(f"Timeout fetching data for {symbol}")
-        return {"error": f"Timeout fetching data for {symbol}"}
     except Exception as e:
-        logger.error(f"Error fetching data for {symbol}: {str(e)}")
+        logger.error("Error fetching data for %s: %s", symbol, e)
         return {"error": f"Stock {symbol} not found: {str(e)}"}
 
+# Yahoo's quote endpoint returns many symbols in a single request; it needs a session
+# cookie (set by fc.yahoo.com) plus the matching crumb, otherwise it answers 401
+YF_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+YF_COOKIE_URL = "https://fc.yahoo.com"
+YF_CRUMB_URL = "https://query1.finance.yahoo.com/v1/test/getcrumb"
+# After a failed quote request, go straight to the fast_info fallback for this long
+QUOTE_BACKOFF = 60.0
+quote_auth = {"crumb": None, "blocked_until": 0.0}
+YF_HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"}
+
+# Async client for the quote endpoint, opened in startup_event so it lives on the serving loop
+client: Optional[httpx.AsyncClient] = None
+
+def create_quote_client() -> httpx.AsyncClient:
+    """Pooled, keep-alive, HTTP/2 multiplexed client for Yahoo"""
+    return httpx.AsyncClient(
+        http2=True,
+        headers=YF_HEADERS,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(5.0, connect=2.0)
+    )
+
+# NSE tickers: letters, digits, '&' and '-' (M&M, BAJAJ-AUTO), optional .NS suffix.
+# normalize_symbol appends .NS, so indices (^NSEI) and other exchange suffixes are rejected
+SYMBOL_PATTERN = re.compile(r"[A-Z0-9&\-]{1,20}(\.NS)?")
+
+def parse_symbols(symbols: str, limit: int) -> List[str]:
+    """Split a comma-separated query value into unique, well-formed symbols (order kept)"""
+    seen = set()
+    symbol_list = []
+    for s in symbols.split(','):
+        s = s.strip().upper()
+        if not s or not SYMBOL_PATTERN.fullmatch(s):
+            continue
+        s = normalize_symbol(s)
+        if s in seen:
+            continue
+        seen.add(s)
+        symbol_list.append(s)
+        if len(symbol_list) == limit:
+            break
+    return symbol_list
+
+# Upper bound on how long an endpoint waits for upstream data before answering 504
+FETCH_TIMEOUT = 6.0
+
+# Global cap on concurrent upstream Yahoo calls, shared by every endpoint (UPSTREAM_CONCURRENCY to tune).
+# Created in startup_event: on Python 3.9 a Semaphore binds the loop current at construction,
+# and gunicorn imports the app before the serving loop exists
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "16"))
+YF_SEM: Optional[asyncio.Semaphore] = None
+
+async def guarded_fetch(func, *args):
+    """Run a blocking upstream fetch in a worker thread once a YF_SEM slot is free"""
+    async with YF_SEM:
+        return await anyio.to_thread.run_sync(func, *args)
+
+# Yahoo's quote endpoint accepts about 20 comma-joined symbols per request
+QUOTE_BATCH_SIZE = 20
+
+async def fetch_quotes(symbols: List[str]):
+    """Raw quote records keyed by symbol, one request per QUOTE_BATCH_SIZE chunk, or None if any fails"""
+    chunks = await asyncio.gather(*(
+        fetch_quote_chunk(symbols[i:i + QUOTE_BATCH_SIZE])
+        for i in range(0, len(symbols), QUOTE_BATCH_SIZE)
+    ))
+    if any(chunk is None for chunk in chunks):
+        return None
+    quotes = {}
+    for chunk in chunks:
+        quotes.update(chunk)
+    return quotes
+
+async def get_crumb(refresh: bool = False) -> str:
+    """Crumb for the quote endpoint; the session cookie it belongs to stays in the client's jar"""
+    if quote_auth["crumb"] and not refresh:
+        return quote_auth["crumb"]
+    await client.get(YF_COOKIE_URL)  # answers 404 but sets the cookie
+    response = await client.get(YF_CRUMB_URL)
+    response.raise_for_status()
+    crumb = response.text.strip()
+    if not crumb or "<" in crumb:
+        raise ValueError("No crumb in response")
+    quote_auth["crumb"] = crumb
+    return crumb
+
+async def fetch_quote_chunk(symbols: List[str]):
+    """Raw quote records keyed by symbol from one async request, or None if the request fails"""
+    if time.monotonic() < quote_auth["blocked_until"]:
+        # Recently rejected: skip the doomed round trip and let the caller fall back
+        return None
+    try:
+        async with YF_SEM:
+            params = {"symbols": ",".join(symbols)}
+            params["crumb"] = await single_flight(("crumb",), get_crumb)
+            response = await client.get(YF_QUOTE_URL, params=params)
+            if response.status_code == 401:
+                # Crumb expired with its cookie; get a fresh pair and retry once
+                params["crumb"] = await single_flight(("crumb",), lambda: get_crumb(refresh=True))
+                response = await client.get(YF_QUOTE_URL, params=params)
+        response.raise_for_status()
+        return {q.get("symbol"): q for q in response.json()["quoteResponse"]["result"]}
+    except Exception as e:
+        quote_auth["blocked_until"] = time.monotonic() + QUOTE_BACKOFF
+        logger.warning("Quote request failed, using fast_info for %.0fs: %s: %s", QUOTE_BACKOFF, type(e).__name__, e)
+        return None
+
+async def fetch_batch_prices(symbols: List[str]):
+    """Price-only data for several (normalized) symbols from one quote request, or None if the request fails"""
+    logger.info("Fetching batch quote for %s symbols", len(symbols))
+    quotes = await fetch_quotes(symbols)
+    if quotes is None:
+        return None
+    
+    results = []
+    now = int(time.time())  # one timestamp for the whole batch
+    for symbol in symbols:
+        data = quotes.get(symbol)
+        if not data:
+            results.append({"error": f"No data available for {symbol}"})
+            continue
+        result = build_stock_result(symbol, data, "price_only", now)
+        set_cache_data(symbol, result, "price_only")
+        results.append(result)
+    await store_l2(results, "price_only")
+    return results
+
+async def fetch_price_async(symbol: str):
+    """Price-only data via the async quote client, falling back to yfinance fast_info"""
+    results = await fetch_batch_prices([symbol])
+    if results is None:
+        return await fetch_fast_price(symbol)
+    if "error" in results[0]:
+        logger.error("%s", results[0]["error"])
+    return results[0]
+
+async def fetch_fast_price(symbol: str):
+    """Price-only data from yfinance fast_info in a worker thread, written through to L2"""
+    result = await guarded_fetch(fetch_optimized_stock_data, symbol, "price_only")
+    await store_l2([result], "price_only")
+    return result
+
+async def fetch_company_data(symbol: str, data_type: str):
+    """Full/summary data via Ticker.info in a worker thread, written through to L2"""
+    result = await guarded_fetch(fetch_optimized_stock_data, symbol, data_type)
+    await store_l2([result], data_type)
+    return result
+
+async def refresh_price(symbol: str):
+    """Revalidate a stale price entry after the response has been sent"""
+    try:
+        await fetch_coalesced(symbol, "price_only")
+    except Exception as e:
+        logger.error("Background refresh failed for %s: %s", symbol, e)
+
+# In-flight fetches keyed by request identity, so concurrent misses share one upstream call
+inflight: Dict[tuple, asyncio.Future] = {}
+
+async def single_flight(key: tuple, coro_factory):
+    """Run coro_factory() once per key; concurrent callers with the same key share its result"""
+    future = inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(coro_factory())
+        inflight[key] = future
+        future.add_done_callback(lambda _: inflight.pop(key, None))
+    # Shield so one cancelled caller doesn't cancel the fetch for the others
+    return await asyncio.shield(future)
+
+async def fetch_coalesced(symbol: str, data_type: str = "full"):
+    """Fetch a symbol, joining an identical fetch if one is already running"""
+    if data_type == "price_only":
+        # Prices come straight from the quote endpoint on the event loop
+        return await single_flight((data_type, symbol), lambda: fetch_price_async(symbol))
+    # Fundamentals are only in Ticker.info, which still needs a worker thread
+    return await single_flight((data_type, symbol), lambda: fetch_company_data(symbol, data_type))
+
+async def fetch_price_fallback(symbol: str):
+    """fast_info price once the batched quote request has failed, so the quote endpoint isn't retried per symbol"""
+    return await single_flight(("price_only", symbol), lambda: fetch_fast_price(symbol))
+
+# Static body, serialized once at import time
+ROOT_BYTES = orjson.dumps({
+    "message": "Welcome to FinCredo API",
+    "status": "running",
+    "docs": "Visit /docs for API documentation"
+})
+
 @app.get("/")
 async def root():
-    return {
-        "message": "Welcome to FinCredo API",
-        "status": "running",
-        "docs": "Visit /docs for API documentation"
-    }
-
-@app.get("/health")
-async def health_check():
-    return {"status": "healthy", "service": "FinCredo API"}
+    return Response(content=ROOT_BYTES, media_type="application/json")
 
 @app.get("/stock/{symbol}")
 async def get_stock(symbol: str):
     """Full comprehensive stock data"""
     try:
-        # Add .NS suffix if not present
-        if not symbol.endswith('.NS'):
-            symbol += '.NS'
-            
-        cached_data = get_cached_data(symbol, "company")
-        if cached_data:
-            cached_data["cached"] = True
-            return JSONResponse(content=cached_data)
+        symbol = normalize_symbol(symbol)
+        entry = await lookup_cache(symbol, "full")
+        if entry:
+            return Response(content=entry[2], media_type="application/json")
         
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(executor, fetch_optimized_stock_data, symbol, "full")
+        result = await asyncio.wait_for(fetch_coalesced(symbol, "full"), FETCH_TIMEOUT)
         
         if "error" in result:
             raise HTTPException(status_code=404, detail=result["error"])
             
-        result["cached"] = False
-        return JSONResponse(content=result)
+        return ORJSONResponse(content={**result, "cached": False})
     except asyncio.CancelledError:
-        logger.info(f"Request cancelled for {symbol}")
+        logger.info("Request cancelled for %s", symbol)
         raise HTTPException(status_code=408, detail="Request cancelled")
+    except asyncio.TimeoutError:
+        logger.error("Timed out fetching %s", symbol)
+        raise HTTPException(status_code=504, detail="Upstream timeout")
     except Exception as e:
-        logger.error(f"Error in get_stock: {str(e)}")
+        logger.error("Error in get_stock: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 # OPTIMIZED ENDPOINTS FOR N8N
 
 @app.get("/price/{symbol}")
-async def get_price_only(symbol: str):
+async def get_price_only(symbol: str, background: BackgroundTasks, if_none_match: Optional[str] = Header(None)):
     """
     Ultra-fast price-only endpoint for n8n bots
     Returns only essential price data with 30-second cache
     Perfect for high-frequency price monitoring
+    Sends ETag/Cache-Control so pollers can revalidate with If-None-Match (304)
+    Recently expired prices are served immediately while a background refresh runs
     """
     try:
-        cached_data = get_cached_data(symbol, "price")
-        if cached_data:
-            cached_data["cached"] = True
-            return JSONResponse(content=cached_data)
+        symbol = normalize_symbol(symbol)
+        entry = await lookup_cache(symbol, "price_only")
+        if entry:
+            _, deadline, cached_payload, etag = entry
+            max_age = max(0, int(deadline - time.monotonic()))
+            headers = {"Cache-Control": f"public, max-age={max_age}", "ETag": etag}
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=headers)
+            return Response(content=cached_payload, media_type="application/json", headers=headers)
+        
+        stale = get_stale_price_entry(symbol)
+        if stale:
+            # Stale-while-revalidate: answer now, refresh after the response
+            # (single_flight collapses refreshes scheduled by concurrent requests)
+            if ("price_only", symbol) not in inflight:
+                background.add_task(refresh_price, symbol)
+            headers = {"Cache-Control": "public, max-age=0", "ETag": stale[3]}
+            if etag_matches(if_none_match, stale[3]):
+                return Response(status_code=304, headers=headers)
+            return Response(content=stale[2], media_type="application/json", headers=headers)
         
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(executor, fetch_optimized_stock_data, symbol, "price_only")
+        result = await asyncio.wait_for(fetch_coalesced(symbol, "price_only"), FETCH_TIMEOUT)
         
         if "error" in result:
             raise HTTPException(status_code=404, detail=result["error"])
-            
-        result["cached"] = False
-        return JSONResponse(content=result)
+        
+        # Reuse the ETag set_cache_data computed for this result, so later hits revalidate against it
+        with cache_lock:
+            entry = caches["price_only"].get(symbol)
+        headers = {"Cache-Control": f"public, max-age={PRICE_CACHE_DURATION}"}
+        if entry is not None:
+            headers["ETag"] = entry[3]
+            if etag_matches(if_none_match, entry[3]):
+                return Response(status_code=304, headers=headers)
+        return ORJSONResponse(content={**result, "cached": False}, headers=headers)
     except asyncio.CancelledError:
-        logger.info(f"Request cancelled for {symbol}")
+        logger.info("Request cancelled for %s", symbol)
         raise HTTPException(status_code=408, detail="Request cancelled")
+    except asyncio.TimeoutError:
+        logger.error("Timed out fetching %s", symbol)
+        raise HTTPException(status_code=504, detail="Upstream timeout")
     except Exception as e:
-        logger.error(f"Error in get_price_only: {str(e)}")
+        logger.error("Error in get_price_only: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/summary/{symbol}")
@@ -281,24 +642,25 @@ async def get_summary_optimized(symbol: str):
     Returns key metrics with smart caching
     """
     try:
-        cached_data = get_cached_data(symbol, "company")
-        if cached_data:
-            cached_data["cached"] = True
-            return JSONResponse(content=cached_data)
+        symbol = normalize_symbol(symbol)
+        entry = await lookup_cache(symbol, "summary")
+        if entry:
+            return Response(content=entry[2], media_type="application/json")
         
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(executor, fetch_optimized_stock_data, symbol, "summary")
+        result = await asyncio.wait_for(fetch_coalesced(symbol, "summary"), FETCH_TIMEOUT)
         
         if "error" in result:
             raise HTTPException(status_code=404, detail=result["error"])
             
-        result["cached"] = False
-        return JSONResponse(content=result)
+        return ORJSONResponse(content={**result, "cached": False})
     except asyncio.CancelledError:
-        logger.info(f"Request cancelled for {symbol}")
+        logger.info("Request cancelled for %s", symbol)
         raise HTTPException(status_code=408, detail="Request cancelled")
+    except asyncio.TimeoutError:
+        logger.error("Timed out fetching %s", symbol)
+        raise HTTPException(status_code=504, detail="Upstream timeout")
     except Exception as e:
-        logger.error(f"Error in get_summary_optimized: {str(e)}")
+        logger.error("Error in get_summary_optimized: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/batch/price")
@@ -307,21 +669,46 @@ async def get_batch_prices(symbols: str):
     Batch price endpoint optimized for n8n
     Usage: /batch/price?symbols=TCS.NS,RELIANCE.NS,INFY.NS
     """
+    symbol_list = parse_symbols(symbols, 20)  # Limit to 20 symbols
+    if not symbol_list:
+        raise HTTPException(status_code=400, detail="No valid symbols provided")
+    
     try:
-        symbol_list = [s.strip() for s in symbols.split(',')[:20]]  # Limit to 20 symbols
+        # Prices already cached in this worker or in Redis skip the upstream request
+        cached = await lookup_cache_many(symbol_list, "price_only")
+        missing = [symbol for symbol in symbol_list if symbol not in cached]
+        fetched = {}
         
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(executor, fetch_optimized_stock_data, symbol, "price_only")
-            for symbol in symbol_list
-        ]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        async def fetch_missing():
+            # One upstream request for the rest, shared by identical concurrent batches
+            results = await single_flight(("batch", *missing), lambda: fetch_batch_prices(missing))
+            if results is None:
+                # Quote endpoint unavailable, fall back to one fast_info fetch per symbol
+                tasks = [
+                    fetch_price_fallback(symbol)
+                    for symbol in missing
+                ]
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+            return results
         
-        successful_results = [r for r in results if isinstance(r, dict) and "error" not in r]
-        errors = [str(r) if isinstance(r, Exception) else r.get("error", "Unknown error") 
-                 for r in results if isinstance(r, Exception) or (isinstance(r, dict) and "error" in r)]
+        if missing:
+            # One deadline covers the quote request and any fallback
+            fetched = dict(zip(missing, await asyncio.wait_for(fetch_missing(), FETCH_TIMEOUT)))
         
-        return JSONResponse(content={
+        results = [cached[symbol][0] if symbol in cached else fetched[symbol] for symbol in symbol_list]
+        
+        # Single pass over the results
+        successful_results, errors = [], []
+        for r in results:
+            if isinstance(r, Exception):
+                errors.append(str(r))
+            elif "error" in r:
+                errors.append(r["error"])
+            else:
+                successful_results.append(r)
+        
+        # Nested list of up to 20 dicts: skip jsonable_encoder and let orjson walk it once
+        return ORJSONResponse(content={
             "count": len(symbol_list),
             "successful": len(successful_results),
             "prices": successful_results,
@@ -331,8 +718,11 @@ async def get_batch_prices(symbols: str):
     except asyncio.CancelledError:
         logger.info("Batch request cancelled")
         raise HTTPException(status_code=408, detail="Request cancelled")
+    except asyncio.TimeoutError:
+        logger.error("Timed out fetching batch of %s symbols", len(symbol_list))
+        raise HTTPException(status_code=504, detail="Upstream timeout")
     except Exception as e:
-        logger.error(f"Error in get_batch_prices: {str(e)}")
+        logger.error("Error in get_batch_prices: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/watchlist")
@@ -340,86 +730,197 @@ async def get_watchlist_data(symbols: str, type: str = "summary"):
     """
     Optimized watchlist endpoint for n8n
     Usage: /watchlist?symbols=TCS.NS,RELIANCE.NS&type=price
+    Streams each symbol as soon as its fetch completes (completion order);
+    type=price is served from a single batched quote request
     """
+    symbol_list = parse_symbols(symbols, 15)  # Limit to 15 symbols
+    if not symbol_list:
+        raise HTTPException(status_code=400, detail="No valid symbols provided")
+    
     try:
-        symbol_list = [s.strip() for s in symbols.split(',')[:15]]  # Limit to 15 symbols
         data_type = "price_only" if type == "price" else "summary"
         
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(executor, fetch_optimized_stock_data, symbol, data_type)
-            for symbol in symbol_list
-        ]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        async def completed_results():
+            # Cached entries (this worker or Redis) go out first
+            cached = await lookup_cache_many(symbol_list, data_type)
+            for entry in cached.values():
+                yield entry[0]
+            pending = [symbol for symbol in symbol_list if symbol not in cached]
+            if not pending:
+                return
+            # One deadline for all upstream work, whichever path it takes
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + FETCH_TIMEOUT
+            if data_type == "price_only":
+                # The remaining prices come from one quote request
+                try:
+                    batch = await asyncio.wait_for(fetch_batch_prices(pending), FETCH_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # Headers are already sent, so end the list rather than answering 504
+                    logger.error("Watchlist quote request timed out")
+                    return
+                if batch is not None:
+                    for result in batch:
+                        yield result
+                    return
+            if data_type == "price_only":
+                # Prices only get here when the quote request failed, so go straight to fast_info
+                tasks = [fetch_price_fallback(symbol) for symbol in pending]
+            else:
+                tasks = [fetch_coalesced(symbol, data_type) for symbol in pending]
+            for next_result in asyncio.as_completed(tasks, timeout=max(0.0, deadline - loop.time())):
+                try:
+                    yield await next_result
+                except asyncio.TimeoutError:
+                    # as_completed gives up on every remaining fetch at once
+                    logger.error("Watchlist fetches timed out")
+                    break
+                except Exception as e:
+                    logger.error("Watchlist fetch failed: %s", e)
         
-        successful_results = [r for r in results if isinstance(r, dict) and "error" not in r]
+        async def stream_watchlist():
+            count = 0
+            yield b'{"watchlist":['
+            async for result in completed_results():
+                if "error" in result:
+                    continue
+                yield (b',' if count else b'') + orjson.dumps(result)
+                count += 1
+            yield b'],"count":%d,"type":%s,"timestamp":%d}' % (count, orjson.dumps(type), int(time.time()))
         
-        return JSONResponse(content={
-            "watchlist": successful_results,
-            "count": len(successful_results),
-            "type": type,
-            "timestamp": int(time.time())
-        })
+        return StreamingResponse(stream_watchlist(), media_type="application/json")
     except asyncio.CancelledError:
         logger.info("Watchlist request cancelled")
         raise HTTPException(status_code=408, detail="Request cancelled")
     except Exception as e:
-        logger.error(f"Error in get_watchlist_data: {str(e)}")
+        logger.error("Error in get_watchlist_data: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
+# Static catalog, serialized once at import time
+POPULAR_STOCKS = {
+    "nifty50_top10": [
+        "RELIANCE.NS", "TCS.NS", "HDFCBANK.NS", "INFY.NS", "HINDUNILVR.NS",
+        "ICICIBANK.NS", "SBIN.NS", "BHARTIARTL.NS", "ITC.NS", "KOTAKBANK.NS"
+    ],
+    "sectors": {
+        "IT": ["TCS.NS", "INFY.NS", "HCLTECH.NS", "WIPRO.NS"],
+        "Banking": ["HDFCBANK.NS", "ICICIBANK.NS", "SBIN.NS", "KOTAKBANK.NS"],
+        "Energy": ["RELIANCE.NS", "ONGC.NS", "NTPC.NS"],
+        "Auto": ["MARUTI.NS", "TATAMOTORS.NS", "BAJAJ-AUTO.NS"]
+    }
+}
+POPULAR_BYTES = orjson.dumps(POPULAR_STOCKS)
+POPULAR_SYMBOLS = list(dict.fromkeys(
+    POPULAR_STOCKS["nifty50_top10"] + [s for group in POPULAR_STOCKS["sectors"].values() for s in group]
+))
+
+# Pre-populate the full and summary caches for popular symbols at startup. Off by default without
+# Redis: every worker would warm its own L1, multiplying the Ticker.info burst at boot (WARM_CACHE=1/0 overrides)
+WARM_CACHE = os.getenv("WARM_CACHE", "1" if redis_client is not None else "0") != "0"
+# With Redis, only the worker holding this key warms; the others read the results from L2 on demand
+WARM_LOCK_KEY = "fincredo:warmup"
+background_tasks = set()
+
+async def warm_popular_cache():
+    """Fetch full data for POPULAR_SYMBOLS so first hits after boot are served from cache"""
+    if redis_client is not None:
+        try:
+            if not await redis_client.set(WARM_LOCK_KEY, os.getpid(), nx=True, ex=TTLS["full"]):
+                logger.info("Skipping cache warmup; another worker is warming")
+                return
+        except Exception as e:
+            logger.warning("Skipping cache warmup, Redis unavailable: %s: %s", type(e).__name__, e)
+            return
+    start = time.time()
+    # Symbols another worker already put in Redis only need copying into L1
+    cached = await lookup_cache_many(POPULAR_SYMBOLS, "full")
+    results = await asyncio.gather(
+        *(fetch_coalesced(symbol, "full") for symbol in POPULAR_SYMBOLS if symbol not in cached),
+        return_exceptions=True
+    )
+    warmed = len(cached) + sum(1 for r in results if isinstance(r, dict) and "error" not in r)
+    logger.info("Warmed cache for %s/%s popular symbols (%s already cached) in %.1fs",
+                warmed, len(POPULAR_SYMBOLS), len(cached), time.time() - start)
+
 @app.get("/popular/indian")
 async def get_popular_indian_stocks():
     """Popular Indian stocks for quick access"""
-    popular_stocks = {
-        "nifty50_top10": [
-            "RELIANCE.NS", "TCS.NS", "HDFCBANK.NS", "INFY.NS", "HINDUNILVR.NS",
-            "ICICIBANK.NS", "SBIN.NS", "BHARTIARTL.NS", "ITC.NS", "KOTAKBANK.NS"
-        ],
-        "sectors": {
-            "IT": ["TCS.NS", "INFY.NS", "HCLTECH.NS", "WIPRO.NS"],
-            "Banking": ["HDFCBANK.NS", "ICICIBANK.NS", "SBIN.NS", "KOTAKBANK.NS"],
-            "Energy": ["RELIANCE.NS", "ONGC.NS", "NTPC.NS"],
-            "Auto": ["MARUTI.NS", "TATAMOTORS.NS", "BAJAJ-AUTO.NS"]
-        }
-    }
-    return JSONResponse(content=popular_stocks)
+    return Response(content=POPULAR_BYTES, media_type="application/json")
 
 @app.get("/health")
-def health_check():
+async def health_check():
     """Health check with cache stats"""
-    return JSONResponse(content={
+    return {
         "status": "healthy",
-        "cache_size": len(cache),
+        "service": "FinCredo API",
+        "cache_size": sum(len(cache) for cache in caches.values()),
         "timestamp": int(time.time()),
         "version": "2.0.0"
-    })
+    }
 
 @app.get("/metrics")
-def get_metrics():
+async def get_metrics():
     """API metrics for monitoring"""
-    return JSONResponse(content={
-        "cache_size": len(cache),
-        "cache_hit_ratio": "N/A",  # You can implement this
+    hits, misses = cache_stats["hits"], cache_stats["misses"]
+    lookups = hits + misses
+    ratio = hits / lookups if lookups else None
+    if lookups >= MIN_LOOKUPS_FOR_RATIO and ratio < LOW_HIT_RATIO:
+        logger.warning("Cache hit ratio %.2f is below %.2f; consider longer cache durations", ratio, LOW_HIT_RATIO)
+    return {
+        "cache_size": sum(len(cache) for cache in caches.values()),
+        "cache_hits": hits,
+        "cache_misses": misses,
+        "l2_hits": cache_stats["l2_hits"],
+        "cache_hit_ratio": round(ratio, 4) if lookups else "N/A",
         "timestamp": int(time.time())
-    })
+    }
+
+async def startup_event():
+    """Open the quote client, create YF_SEM on the serving loop, size the worker thread pool and start cache warmup"""
+    global client, YF_SEM
+    client = create_quote_client()
+    YF_SEM = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_LIMIT
+    if WARM_CACHE:
+        # Don't block startup on Yahoo; warm in the background
+        task = asyncio.ensure_future(warm_popular_cache())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
 
-@app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown"""
     logger.info("Shutting down FinCredo API...")
-    executor.shutdown(wait=False)
+    await client.aclose()
+    session.close()
+    if redis_client is not None:
+        await redis_client.close()
+
+# Serialized once; only the timestamp is filled in per request
+TEST_HEAD, TEST_TAIL = orjson.dumps({
+    "status": "working",
+    "message": "FinCredo API is running",
+    "timestamp": "__TS__",
+    "test_urls": {
+        "price_only": "/price/TCS",
+        "summary": "/summary/TCS", 
+        "full_data": "/stock/TCS"
+    }
+}).split(b'"__TS__"')
 
 # Add a simple test endpoint
 @app.get("/test")
 async def test_endpoint():
     """Simple test endpoint to verify API is working"""
-    return {
-        "status": "working",
-        "message": "FinCredo API is running",
-        "timestamp": int(time.time()),
-        "test_urls": {
-            "price_only": "/price/TCS",
-            "summary": "/summary/TCS", 
-            "full_data": "/stock/TCS"
-        }
-    }
+    return Response(content=TEST_HEAD + b"%d" % int(time.time()) + TEST_TAIL, media_type="application/json")
+
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop + httptools come with uvicorn[standard] (uvloop is unavailable on Windows)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="asyncio" if os.name == "nt" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1"))
+    )